@@ -2,15 +2,39 @@ from __future__ import annotations
 
 from dataclasses import dataclass, asdict
 from datetime import date
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, AsyncIterator, Dict, FrozenSet, Iterable, List, Optional, Tuple
+import asyncio
+import hmac
+import json
 import math
+import os
 import re
+import threading
+import time
+import uuid
 
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
 
-app = FastAPI(title="ClubMed API (Mock)", version="0.3.0")
+import clubmed_tracing as tracing
+
+tracing.setup("clubmed-api")
+
+
+class _TracedJSONResponse(JSONResponse):
+    # Times the final JSON encoding, which happens after the route returns
+    def render(self, content: Any) -> bytes:
+        with tracing.span("encode"):
+            return super().render(content)
+
+
+app = FastAPI(
+    title="ClubMed API (Mock)",
+    version="0.3.0",
+    default_response_class=_TracedJSONResponse,
+)
 
 # Allow your Vite dev server to call this API
 app.add_middleware(
@@ -22,8 +46,40 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Catalog-Version", "X-Catalog-Epoch"],
 )
 
+
+async def _trace_requests(request: Request, call_next: Any) -> Response:
+    # Continues the caller's trace (traceparent header) when there is one
+    # Named by route template once routing is done; unmatched paths share one
+    # name so arbitrary URLs can't mint new span names
+    attrs = {"http.method": request.method, "http.target": request.url.path}
+    with tracing.span(f"{request.method} unmatched", parent=tracing.extract(request.headers), **attrs) as s:
+        response = await call_next(request)
+        if s is not None:
+            route = request.scope.get("route")
+            if route is not None:
+                s.update_name(f"{request.method} {route.path}")
+            s.set_attribute("http.status_code", response.status_code)
+        return response
+
+
+# Only pay for the middleware wrapping when spans are actually exported
+if tracing.enabled():
+    app.middleware("http")(_trace_requests)
+
+# /admin/* routes require a matching X-Admin-Token header. Without a token
+# they refuse writes, unless CLUBMED_ADMIN_OPEN=1 explicitly allows anyone.
+ADMIN_TOKEN = os.getenv("CLUBMED_ADMIN_TOKEN", "")
+ADMIN_OPEN = os.getenv("CLUBMED_ADMIN_OPEN", "0") == "1"
+# How many change events the feed keeps for clients resuming with ?since=
+CHANGE_LOG_SIZE = int(os.getenv("CLUBMED_CHANGE_LOG_SIZE", "1000"))
+CHANGE_KEEPALIVE_S = 15.0
+# The catalog lives in memory, so versions restart at 1 with the process.
+# The epoch tells clients which process a version number belongs to.
+CATALOG_EPOCH = uuid.uuid4().hex[:12]
+
 # ----------------------------
 # Mock data model (matches React shape)
 # ----------------------------
@@ -120,10 +176,8 @@ def _norm(s: str) -> str:
     return re.sub(r"\s+", " ", s.strip().lower())
 
 
-def _match_hotel(h: Hotel, q: str) -> bool:
-    qn = _norm(q)
-    hay = " ".join([h.id, h.name, h.country, h.region, " ".join(h.themes)]).lower()
-    return qn in hay
+def _haystack(h: Hotel) -> str:
+    return " ".join([h.id, h.name, h.country, h.region, " ".join(h.themes)]).lower()
 
 
 def _bounds_xy(points: List[Tuple[float, float]]) -> Dict[str, float]:
@@ -133,6 +187,26 @@ def _bounds_xy(points: List[Tuple[float, float]]) -> Dict[str, float]:
     return {"minX": min(xs), "maxX": max(xs), "minY": min(ys), "maxY": max(ys)}
 
 
+def _parse_bbox(bbox: str) -> Tuple[float, float, float, float]:
+    # "minX,minY,maxX,maxY" (X=lng, Y=lat), same axes as the bounds we return
+    try:
+        min_x, min_y, max_x, max_y = (float(p) for p in bbox.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox must be minX,minY,maxX,maxY")
+    if not all(math.isfinite(v) for v in (min_x, min_y, max_x, max_y)):
+        raise HTTPException(status_code=400, detail="bbox values must be finite numbers")
+    if min_x > max_x or min_y > max_y:
+        raise HTTPException(status_code=400, detail="bbox min must not exceed max")
+    # Nothing lives outside real coordinates; clamping also bounds the grid walk
+    return max(min_x, -180.0), max(min_y, -90.0), min(max_x, 180.0), min(max_y, 90.0)
+
+
+def _to_payload(h: Hotel) -> Dict[str, Any]:
+    d = asdict(h)
+    d["coordinates"] = h.coordinates
+    return d
+
+
 def _nights_between(check_in: str, check_out: str) -> int:
     y1, m1, d1 = map(int, check_in.split("-"))
     y2, m2, d2 = map(int, check_out.split("-"))
@@ -175,6 +249,215 @@ def _quote_for(h: Hotel, nights: int, adults: int, children: int) -> Dict[str, A
     }
 
 
+# ----------------------------
+# Catalog indexes
+# ----------------------------
+# Readers grab the current snapshot once and never see it change underneath
+# them. Writers build the next snapshot by copying the outer dicts and only
+# re-indexing the hotel being touched, then swap the module reference.
+GRID_DEG = 10.0
+
+
+def _cell(lng: float, lat: float) -> Tuple[int, int]:
+    return (math.floor(lng / GRID_DEG), math.floor(lat / GRID_DEG))
+
+
+@dataclass(frozen=True)
+class CatalogSnapshot:
+    version: int
+    by_id: Dict[str, Hotel]  # insertion order is listing order
+    rank: Dict[str, int]  # listing position, to order index hits without a full scan
+    next_rank: int
+    haystacks: Dict[str, str]
+    by_theme: Dict[str, FrozenSet[str]]
+    grid: Dict[Tuple[int, int], FrozenSet[str]]
+
+    def ids_in_bbox(self, min_x: float, min_y: float, max_x: float, max_y: float) -> FrozenSet[str]:
+        (cx0, cy0), (cx1, cy1) = _cell(min_x, min_y), _cell(max_x, max_y)
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) <= len(self.grid):
+            cells: Iterable[Tuple[int, int]] = (
+                (cx, cy) for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1)
+            )
+        else:
+            # Big box over a sparse grid: cheaper to visit the occupied cells
+            cells = [c for c in self.grid if cx0 <= c[0] <= cx1 and cy0 <= c[1] <= cy1]
+        out = set()
+        for cell in cells:
+            for hid in self.grid.get(cell, ()):
+                h = self.by_id[hid]
+                if min_x <= h.lng <= max_x and min_y <= h.lat <= max_y:
+                    out.add(hid)
+        return frozenset(out)
+
+
+def _remove_from(index: Dict[Any, FrozenSet[str]], keys: Iterable[Any], hotel_id: str) -> None:
+    for k in keys:
+        rest = index.get(k, frozenset()) - {hotel_id}
+        if rest:
+            index[k] = rest
+        else:
+            index.pop(k, None)
+
+
+def _add_to(index: Dict[Any, FrozenSet[str]], keys: Iterable[Any], hotel_id: str) -> None:
+    for k in keys:
+        index[k] = index.get(k, frozenset()) | {hotel_id}
+
+
+def _theme_keys(h: Hotel) -> List[str]:
+    # Same normalization as query-side lookups in _filter
+    return [_norm(t) for t in h.themes]
+
+
+def _with_hotel(snap: CatalogSnapshot, h: Hotel, version: int) -> CatalogSnapshot:
+    by_id, rank, haystacks = dict(snap.by_id), dict(snap.rank), dict(snap.haystacks)
+    by_theme, grid = dict(snap.by_theme), dict(snap.grid)
+    next_rank = snap.next_rank
+
+    old = by_id.get(h.id)
+    if old:
+        _remove_from(by_theme, _theme_keys(old), old.id)
+        _remove_from(grid, [_cell(old.lng, old.lat)], old.id)
+
+    else:
+        rank[h.id] = next_rank
+        next_rank += 1
+
+    by_id[h.id] = h
+    haystacks[h.id] = _haystack(h)
+    _add_to(by_theme, _theme_keys(h), h.id)
+    _add_to(grid, [_cell(h.lng, h.lat)], h.id)
+    return CatalogSnapshot(version, by_id, rank, next_rank, haystacks, by_theme, grid)
+
+
+def _without_hotel(snap: CatalogSnapshot, hotel_id: str, version: int) -> CatalogSnapshot:
+    by_id, rank, haystacks = dict(snap.by_id), dict(snap.rank), dict(snap.haystacks)
+    by_theme, grid = dict(snap.by_theme), dict(snap.grid)
+
+    old = by_id.pop(hotel_id)
+    rank.pop(hotel_id, None)
+    haystacks.pop(hotel_id, None)
+    _remove_from(by_theme, _theme_keys(old), hotel_id)
+    _remove_from(grid, [_cell(old.lng, old.lat)], hotel_id)
+    return CatalogSnapshot(version, by_id, rank, snap.next_rank, haystacks, by_theme, grid)
+
+
+def _build_snapshot(hotels: Iterable[Hotel]) -> CatalogSnapshot:
+    by_id: Dict[str, Hotel] = {}
+    haystacks: Dict[str, str] = {}
+    by_theme: Dict[str, set] = {}
+    grid: Dict[Tuple[int, int], set] = {}
+    for h in hotels:
+        by_id[h.id] = h
+        haystacks[h.id] = _haystack(h)
+        for t in _theme_keys(h):
+            by_theme.setdefault(t, set()).add(h.id)
+        grid.setdefault(_cell(h.lng, h.lat), set()).add(h.id)
+    return CatalogSnapshot(
+        1,
+        by_id,
+        {hid: i for i, hid in enumerate(by_id)},
+        len(by_id),
+        haystacks,
+        {k: frozenset(v) for k, v in by_theme.items()},
+        {k: frozenset(v) for k, v in grid.items()},
+    )
+
+
+_catalog: CatalogSnapshot = _build_snapshot(HOTELS)
+_write_lock = threading.Lock()
+# Replaced (never mutated) by writers, so the feed reads it without the lock
+_changes: Tuple[Dict[str, Any], ...] = ()
+# (loop, event) per open feed connection, woken when a change is published
+_subscribers: set = set()
+
+
+def _snapshot() -> CatalogSnapshot:
+    return _catalog
+
+
+def _publish(next_snap: CatalogSnapshot, op: str, hotel_id: str, hotel: Optional[Hotel]) -> None:
+    # Caller holds _write_lock
+    global _catalog, _changes
+    event = {
+        "epoch": CATALOG_EPOCH,
+        "version": next_snap.version,
+        "op": op,
+        "id": hotel_id,
+        "hotel": _to_payload(hotel) if hotel else None,
+        "ts": time.time(),
+    }
+    _catalog = next_snap
+    _changes = (_changes + (event,))[-CHANGE_LOG_SIZE:]
+    for loop, wake in list(_subscribers):
+        loop.call_soon_threadsafe(wake.set)
+
+
+def _changes_after(version: int) -> Tuple[Optional[int], List[Dict[str, Any]]]:
+    log = _changes
+    oldest = log[0]["version"] if log else None
+    return oldest, [e for e in log if e["version"] > version]
+
+
+def _search(
+    snap: CatalogSnapshot,
+    q: str = "",
+    country: Optional[str] = None,
+    region: Optional[str] = None,
+    themes: Optional[List[str]] = None,
+    bbox: Optional[Tuple[float, float, float, float]] = None,
+    limit: int = 100,
+) -> List[Hotel]:
+    with tracing.span("filter", **{"catalog.version": snap.version}):
+        res = _filter(snap, q, country, region, themes, bbox, limit)
+        tracing.set_attrs(**{"filter.matched": len(res)})
+        return res
+
+
+def _filter(
+    snap: CatalogSnapshot,
+    q: str,
+    country: Optional[str],
+    region: Optional[str],
+    themes: Optional[List[str]],
+    bbox: Optional[Tuple[float, float, float, float]],
+    limit: int,
+) -> List[Hotel]:
+    candidates: Optional[FrozenSet[str]] = None
+    for t in themes or []:
+        ids = snap.by_theme.get(_norm(t), frozenset())
+        candidates = ids if candidates is None else candidates & ids
+    if bbox:
+        ids = snap.ids_in_bbox(*bbox)
+        candidates = ids if candidates is None else candidates & ids
+
+    qn = _norm(q) if q else ""
+    country_n = _norm(country) if country else None
+    region_n = _norm(region) if region else None
+
+    # Walk only index hits when there are any, in listing order
+    order: Iterable[str] = snap.by_id if candidates is None else sorted(candidates, key=snap.rank.__getitem__)
+
+    res: List[Hotel] = []
+    for hid in order:
+        if len(res) >= max(0, limit):
+            break
+        h = snap.by_id[hid]
+        if qn and qn not in snap.haystacks[hid]:
+            continue
+        if country_n and country_n != _norm(h.country):
+            continue
+        if region_n and region_n != _norm(h.region):
+            continue
+        res.append(h)
+    return res
+
+
+def _version_headers(response: Response, snap: CatalogSnapshot) -> None:
+    response.headers["X-Catalog-Version"] = str(snap.version)
+    response.headers["X-Catalog-Epoch"] = CATALOG_EPOCH
+
+
 # ----------------------------
 # Request schemas
 # ----------------------------
@@ -186,6 +469,21 @@ class QuoteRequest(BaseModel):
     children: int = Field(0, ge=0)
 
 
+class HotelUpsert(BaseModel):
+    name: str
+    country: str
+    region: str
+    themes: List[str] = Field(default_factory=list)
+    minNights: int = Field(1, ge=1)
+    basePrice: int = Field(..., ge=0)
+    childDiscountPct: int = Field(0, ge=0, le=100)
+    rating: float = Field(0, ge=0, le=5)
+    bookingUrl: str = ""
+    lat: float = Field(..., ge=-90, le=90)
+    lng: float = Field(..., ge=-180, le=180)
+    image: str = ""
+
+
 # ----------------------------
 # Routes
 # ----------------------------
@@ -196,72 +494,196 @@ def health() -> Dict[str, str]:
 
 @app.get("/hotels")
 def list_hotels(
+    response: Response,
     q: str = "",
     country: Optional[str] = None,
     region: Optional[str] = None,
     themes: List[str] = Query(default=[]),
     limit: int = 100,
 ) -> Dict[str, Any]:
-    res: List[Hotel] = []
-    for h in HOTELS:
-        if q and not _match_hotel(h, q):
-            continue
-        if country and _norm(country) != _norm(h.country):
-            continue
-        if region and _norm(region) != _norm(h.region):
-            continue
-        if themes and not all(_norm(t) in [x.lower() for x in h.themes] for t in themes):
-            continue
-        res.append(h)
-
-    res = res[: max(0, limit)]
-
-    def to_payload(x: Hotel) -> Dict[str, Any]:
-        d = asdict(x)
-        d["coordinates"] = x.coordinates
-        return d
-
-    return {"count": len(res), "hotels": [to_payload(h) for h in res]}
+    snap = _snapshot()
+    res = _search(snap, q=q, country=country, region=region, themes=themes, limit=limit)
+    _version_headers(response, snap)
+    with tracing.span("serialize"):
+        return {"count": len(res), "hotels": [_to_payload(h) for h in res]}
 
 
 @app.get("/hotels/{hotel_id}")
-def get_hotel(hotel_id: str) -> Dict[str, Any]:
-    h = next((x for x in HOTELS if x.id == hotel_id), None)
+def get_hotel(hotel_id: str, response: Response) -> Dict[str, Any]:
+    snap = _snapshot()
+    h = snap.by_id.get(hotel_id)
     if not h:
         raise HTTPException(status_code=404, detail="Hotel not found")
-    d = asdict(h)
-    d["coordinates"] = h.coordinates
-    return {"hotel": d}
+    _version_headers(response, snap)
+    return {"hotel": _to_payload(h)}
 
 
 @app.get("/map/search")
 def map_search(
+    response: Response,
     q: str = "",
     country: Optional[str] = None,
     region: Optional[str] = None,
     themes: List[str] = Query(default=[]),
+    bbox: Optional[str] = Query(default=None, description="minX,minY,maxX,maxY (X=lng, Y=lat)"),
     limit: int = 100,
 ) -> Dict[str, Any]:
-    data = list_hotels(q=q, country=country, region=region, themes=themes, limit=limit)
-    hotels = data["hotels"]
-
-    if hotels:
-        b = _bounds_xy([(h["coordinates"][0], h["coordinates"][1]) for h in hotels])
-    else:
-        b = {"minX": 0, "maxX": 0, "minY": 0, "maxY": 0}
-
+    snap = _snapshot()
+    found = _search(
+        snap,
+        q=q,
+        country=country,
+        region=region,
+        themes=themes,
+        bbox=_parse_bbox(bbox) if bbox else None,
+        limit=limit,
+    )
+
+    with tracing.span("bounds"):
+        if found:
+            b = _bounds_xy([(h.lng, h.lat) for h in found])
+        else:
+            b = {"minX": 0, "maxX": 0, "minY": 0, "maxY": 0}
+
+    _version_headers(response, snap)
     # Return shape that your UI can consume easily
-    return {"count": len(hotels), "bounds": b, "hotels": hotels}
+    with tracing.span("serialize"):
+        return {"count": len(found), "bounds": b, "hotels": [_to_payload(h) for h in found]}
 
 
 @app.post("/quote")
 def quote(req: QuoteRequest) -> Dict[str, Any]:
-    h = next((x for x in HOTELS if x.id == req.hotel_id), None)
+    h = _snapshot().by_id.get(req.hotel_id)
     if not h:
         raise HTTPException(status_code=404, detail="Hotel not found")
 
-    nights = _nights_between(req.check_in, req.check_out)
+    try:
+        nights = _nights_between(req.check_in, req.check_out)
+    except ValueError:
+        # Bad input, not a server fault: keep it out of client retries/breakers
+        raise HTTPException(status_code=400, detail="check_in/check_out must be YYYY-MM-DD dates")
     if nights <= 0:
         raise HTTPException(status_code=400, detail="check_out must be after check_in")
 
-    return _quote_for(h, nights, req.adults, req.children)
+    with tracing.span("price", **{"hotel.id": h.id, "nights": nights}):
+        return _quote_for(h, nights, req.adults, req.children)
+
+
+# ----------------------------
+# Catalog admin + change feed
+# ----------------------------
+def _check_admin(token: Optional[str]) -> None:
+    if not ADMIN_TOKEN:
+        if ADMIN_OPEN:
+            return
+        raise HTTPException(status_code=403, detail="Admin writes are disabled (set CLUBMED_ADMIN_TOKEN)")
+    if not token or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+
+@app.put("/admin/hotels/{hotel_id}")
+def upsert_hotel(
+    hotel_id: str,
+    req: HotelUpsert,
+    x_admin_token: Optional[str] = Header(default=None),
+) -> Dict[str, Any]:
+    _check_admin(x_admin_token)
+    h = Hotel(
+        id=hotel_id,
+        name=req.name,
+        country=req.country,
+        region=req.region,
+        themes=[_norm(t) for t in req.themes if t.strip()],
+        minNights=req.minNights,
+        basePrice=req.basePrice,
+        childDiscountPct=req.childDiscountPct,
+        rating=req.rating,
+        bookingUrl=req.bookingUrl,
+        lat=req.lat,
+        lng=req.lng,
+        image=req.image,
+    )
+    with _write_lock:
+        snap = _catalog
+        created = hotel_id not in snap.by_id
+        _publish(_with_hotel(snap, h, snap.version + 1), "upsert", hotel_id, h)
+        version = _catalog.version
+    return {"ok": True, "created": created, "version": version, "hotel": _to_payload(h)}
+
+
+@app.delete("/admin/hotels/{hotel_id}")
+def delete_hotel(
+    hotel_id: str,
+    x_admin_token: Optional[str] = Header(default=None),
+) -> Dict[str, Any]:
+    _check_admin(x_admin_token)
+    with _write_lock:
+        snap = _catalog
+        if hotel_id not in snap.by_id:
+            raise HTTPException(status_code=404, detail="Hotel not found")
+        _publish(_without_hotel(snap, hotel_id, snap.version + 1), "delete", hotel_id, None)
+        version = _catalog.version
+    return {"ok": True, "version": version}
+
+
+@app.get("/catalog/version")
+def catalog_version() -> Dict[str, Any]:
+    return {"version": _snapshot().version, "epoch": CATALOG_EPOCH}
+
+
+def _sse(event: str, data: Dict[str, Any], event_id: Optional[int] = None) -> str:
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.get("/catalog/changes")
+async def catalog_changes(
+    request: Request,
+    since: Optional[int] = None,
+    epoch: Optional[str] = None,
+    last_event_id: Optional[str] = Header(default=None),
+) -> StreamingResponse:
+    """
+    SSE feed of catalog changes after `since` (or Last-Event-ID on reconnect).
+    Emits `reset` when the client can't resume: it is too far behind for the
+    retained log, or its version/epoch belongs to an earlier process.
+    """
+    if since is None and last_event_id and last_event_id.isdigit():
+        since = int(last_event_id)
+
+    async def stream() -> AsyncIterator[str]:
+        wake = asyncio.Event()
+        sub = (asyncio.get_running_loop(), wake)
+        _subscribers.add(sub)
+        try:
+            current = _snapshot().version
+            seen = current if since is None else since
+            oldest, _ = _changes_after(seen)
+            behind = seen < (oldest if oldest is not None else current + 1) - 1
+            foreign = (epoch is not None and epoch != CATALOG_EPOCH) or seen > current
+            if since is not None and (behind or foreign):
+                seen = current
+                yield _sse("reset", {"version": seen, "epoch": CATALOG_EPOCH}, seen)
+            else:
+                yield _sse("hello", {"version": current, "epoch": CATALOG_EPOCH})
+
+            while not await request.is_disconnected():
+                _, pending = _changes_after(seen)
+                for e in pending:
+                    seen = e["version"]
+                    yield _sse("change", e, seen)
+                if pending:
+                    continue
+                try:
+                    await asyncio.wait_for(wake.wait(), CHANGE_KEEPALIVE_S)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                wake.clear()
+        finally:
+            _subscribers.discard(sub)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -1,14 +1,55 @@
 from __future__ import annotations
 
+import contextvars
 import json
+import logging
 import os
-from typing import Any, Dict, List, Optional
+import random
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Deque, Dict, List, Optional, Tuple
 
 import httpx
 from fastmcp import FastMCP
 
+import clubmed_tracing as tracing
+
+log = logging.getLogger("clubmed_mcp")
+
 API_BASE_URL = os.getenv("CLUBMED_API_BASE_URL", "http://127.0.0.1:8080")
 TIMEOUT_S = float(os.getenv("CLUBMED_API_TIMEOUT_S", "10"))
+# Upper bound on staleness if the change feed is down; the feed normally evicts first
+CACHE_TTL_S = float(os.getenv("CLUBMED_CACHE_TTL_S", "300"))
+# How long past the TTL an entry may still be served while the API is unhealthy
+CACHE_STALE_S = float(os.getenv("CLUBMED_CACHE_STALE_S", "3600"))
+CACHE_MAX_ENTRIES = int(os.getenv("CLUBMED_CACHE_MAX_ENTRIES", "1000"))
+CHANGE_FEED = os.getenv("CLUBMED_CHANGE_FEED", "1") != "0"
+# The API sends a keepalive this often; silence for twice as long means a dead feed
+CHANGE_KEEPALIVE_S = 15.0
+
+# Whole-call latency budget per tool (retries and hedges included).
+# Override one with e.g. CLUBMED_BUDGET_MAP_SEARCH_S=1.5
+TOOL_BUDGETS_S = {
+    "list_hotels": 3.0,
+    "get_hotel": 2.0,
+    "map_search": 3.0,
+    "get_quote": 3.0,
+    "search": 2.0,
+    "fetch": 2.0,
+}
+RETRIES = int(os.getenv("CLUBMED_RETRIES", "2"))
+RETRY_BASE_S = float(os.getenv("CLUBMED_RETRY_BASE_S", "0.1"))
+RETRY_MAX_S = float(os.getenv("CLUBMED_RETRY_MAX_S", "1.0"))
+# Hedging sends a second copy of a read once it outlives the tool's recent p95
+HEDGE = os.getenv("CLUBMED_HEDGE", "0") != "0"
+HEDGE_MIN_SAMPLES = int(os.getenv("CLUBMED_HEDGE_MIN_SAMPLES", "20"))
+HEDGE_MAX_INFLIGHT = int(os.getenv("CLUBMED_HEDGE_MAX_INFLIGHT", "16"))
+BREAKER_FAILURES = int(os.getenv("CLUBMED_BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN_S = float(os.getenv("CLUBMED_BREAKER_COOLDOWN_S", "10"))
+
+tracing.setup("clubmed-mcp")
 
 mcp = FastMCP(
     name="ClubMed MCP (REST-backed, UI-shaped)",
@@ -21,6 +62,459 @@ mcp = FastMCP(
 def _client() -> httpx.Client:
     return httpx.Client(base_url=API_BASE_URL, timeout=TIMEOUT_S)
 
+
+def _phase_timeout(deadline: float) -> httpx.Timeout:
+    # Waiting for the response may use everything that is left; _request checks
+    # the deadline between chunks. Getting a connection and sending the request
+    # are capped tighter, since they eat into that same budget.
+    left = max(0.001, min(TIMEOUT_S, deadline - time.monotonic()))
+    return httpx.Timeout(left, pool=0.25 * left, connect=0.25 * left, write=0.25 * left)
+
+
+def _request(
+    method: str,
+    path: str,
+    deadline: Optional[float] = None,
+    route: Optional[str] = None,
+    **kwargs: Any,
+) -> httpx.Response:
+    # One span per upstream call, named by route template (`/hotels/{hotel_id}`)
+    # so ids don't multiply span names; connect/TLS/send/receive land on it as events
+    attrs = {"http.method": method, "http.url": API_BASE_URL + path, "http.target": path}
+    with tracing.span(f"http {method} {route or path}", **attrs) as s:
+        if deadline is None:
+            deadline = time.monotonic() + TIMEOUT_S
+        with _client() as c:
+            with c.stream(
+                method,
+                path,
+                headers=tracing.inject(),
+                extensions={"trace": tracing.httpx_trace_hook},
+                timeout=_phase_timeout(deadline),
+                **kwargs,
+            ) as streamed:
+                # The read limit restarts per chunk, so also stop waiting for more
+                # once past the deadline (a complete body is still used)
+                expected = streamed.headers.get("Content-Length")
+                body = bytearray()
+                for chunk in streamed.iter_raw():
+                    body += chunk
+                    complete = expected is not None and len(body) >= int(expected)
+                    if not complete and time.monotonic() > deadline:
+                        raise httpx.ReadTimeout("Latency budget exhausted", request=streamed.request)
+            r = httpx.Response(
+                streamed.status_code,
+                headers=streamed.headers,
+                content=bytes(body),
+                request=streamed.request,
+            )
+        if s is not None:
+            s.set_attribute("http.status_code", r.status_code)
+        r.raise_for_status()
+        return r
+
+
+# ----------------------------
+# Upstream resilience: budgets, retries, hedging, circuit breaker
+# ----------------------------
+class UpstreamUnavailable(RuntimeError):
+    """Raised without calling the API while the circuit breaker is open."""
+
+
+_stats: Counter = Counter()
+_stats_lock = threading.Lock()
+
+
+def _count(name: str, n: int = 1) -> None:
+    with _stats_lock:
+        _stats[name] += n
+    log.debug("upstream %s", name)
+
+
+class _LatencyWindow:
+    def __init__(self, size: int = 200) -> None:
+        self._lock = threading.Lock()
+        self._size = size
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def record(self, key: str, seconds: float) -> None:
+        with self._lock:
+            self._samples.setdefault(key, deque(maxlen=self._size)).append(seconds)
+
+    def p95(self, key: str) -> Optional[float]:
+        with self._lock:
+            xs = sorted(self._samples.get(key, ()))
+        if len(xs) < HEDGE_MIN_SAMPLES:
+            return None
+        return xs[min(len(xs) - 1, int(len(xs) * 0.95))]
+
+
+class _CircuitBreaker:
+    """
+    Opens after BREAKER_FAILURES consecutive failed attempts. After the
+    cooldown a single probe is let through; only its outcome closes or
+    reopens the breaker.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at < BREAKER_COOLDOWN_S:
+                return "open"
+            return "half-open"
+
+    def allow(self) -> Tuple[bool, bool]:
+        """Returns (allowed, probe); pass `probe` back to record/release."""
+        with self._lock:
+            if self._opened_at is None:
+                return True, False
+            if time.monotonic() - self._opened_at < BREAKER_COOLDOWN_S or self._probing:
+                return False, False
+            self._probing = True
+            _count("breaker.probe")
+            return True, True
+
+    def record(self, ok: bool, probe: bool) -> None:
+        with self._lock:
+            if self._opened_at is not None and not probe:
+                # Calls admitted before the breaker opened don't get a say
+                return
+            if probe:
+                self._probing = False
+            if ok:
+                if self._opened_at is not None:
+                    _count("breaker.closed")
+                self._failures, self._opened_at = 0, None
+                return
+            self._failures += 1
+            if probe or self._failures >= BREAKER_FAILURES:
+                if self._opened_at is None:
+                    _count("breaker.opened")
+                self._opened_at = time.monotonic()
+
+    def release(self, probe: bool) -> None:
+        # Frees the probe slot even if the probe died on an unexpected exception
+        if probe:
+            with self._lock:
+                self._probing = False
+
+
+_latency = _LatencyWindow()
+_breaker = _CircuitBreaker()
+_hedge_pool = ThreadPoolExecutor(max_workers=HEDGE_MAX_INFLIGHT, thread_name_prefix="clubmed-hedge")
+# One slot per pool worker, so a hedge never queues behind losing copies
+_hedge_slots = threading.BoundedSemaphore(HEDGE_MAX_INFLIGHT)
+
+
+def _budget(tool: str) -> float:
+    return float(os.getenv(f"CLUBMED_BUDGET_{tool.upper()}_S", TOOL_BUDGETS_S.get(tool, TIMEOUT_S)))
+
+
+def _retryable(e: Exception) -> bool:
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code >= 500 or e.response.status_code == 429
+    return isinstance(e, httpx.TransportError)
+
+
+def _timed(tool: str, method: str, path: str, deadline: float, **kwargs: Any) -> httpx.Response:
+    started = time.monotonic()
+    r = _request(method, path, deadline=deadline, **kwargs)
+    _latency.record(tool, time.monotonic() - started)
+    return r
+
+
+def _spawn(ctx: contextvars.Context, *args: Any, **kwargs: Any) -> Future:
+    # A dedicated thread for the primary copy: it must never wait for a pool slot
+    fut: Future = Future()
+
+    def run() -> None:
+        try:
+            fut.set_result(ctx.run(_timed, *args, **kwargs))
+        except BaseException as e:
+            fut.set_exception(e)
+
+    threading.Thread(target=run, name="clubmed-primary", daemon=True).start()
+    return fut
+
+
+def _hedge(ctx: contextvars.Context, *args: Any, **kwargs: Any) -> httpx.Response:
+    try:
+        return ctx.run(_timed, *args, **kwargs)
+    finally:
+        _hedge_slots.release()
+
+
+def _attempt(tool: str, method: str, path: str, deadline: float, **kwargs: Any) -> httpx.Response:
+    hedge_after = _latency.p95(tool) if HEDGE else None
+    if hedge_after is None or time.monotonic() + hedge_after >= deadline:
+        return _timed(tool, method, path, deadline, **kwargs)
+
+    # Each copy runs in its own context so its span parents to the tool span.
+    # The caller only waits until the deadline; a losing copy runs out on its own
+    # timeout, which the same deadline bounds.
+    futures = [_spawn(contextvars.copy_context(), tool, method, path, deadline, **kwargs)]
+    done, _ = wait(futures, timeout=hedge_after)
+    if not done:
+        if _hedge_slots.acquire(blocking=False):
+            _count("hedge.sent")
+            futures.append(
+                _hedge_pool.submit(_hedge, contextvars.copy_context(), tool, method, path, deadline, **kwargs)
+            )
+        else:
+            _count("hedge.skipped")
+
+    pending, err = set(futures), None
+    while pending:
+        done, pending = wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+        if not done:
+            raise httpx.TimeoutException("Latency budget exhausted")
+        for f in done:
+            e = f.exception()
+            if e is None:
+                if f is not futures[0]:
+                    _count("hedge.won")
+                return f.result()
+            if not _retryable(e):
+                raise e
+            err = e
+    raise err  # type: ignore[misc]
+
+
+def _call(tool: str, method: str, path: str, **kwargs: Any) -> httpx.Response:
+    """
+    Run one idempotent read against the API within the tool's budget,
+    retrying transport errors, 5xx and 429 with full-jitter backoff.
+    """
+    deadline = time.monotonic() + _budget(tool)
+    attempt = 0
+    while True:
+        allowed, probe = _breaker.allow()
+        if not allowed:
+            _count("breaker.rejected")
+            raise UpstreamUnavailable("ClubMed API is unavailable (circuit open)")
+
+        attempt += 1
+        _count("attempt")
+        try:
+            r = _attempt(tool, method, path, deadline, **kwargs)
+        except httpx.HTTPError as e:
+            if not _retryable(e):
+                # The API answered; a 404 says nothing about its health
+                _breaker.record(True, probe)
+                raise
+            _count("attempt.failed")
+            _breaker.record(False, probe)
+            tracing.set_attrs(**{"upstream.attempts": attempt})
+            if attempt > RETRIES:
+                _count("retry.exhausted")
+                raise
+            delay = random.uniform(0, min(RETRY_MAX_S, RETRY_BASE_S * 2 ** (attempt - 1)))
+            if time.monotonic() + delay >= deadline:
+                _count("budget.exhausted")
+                raise
+        else:
+            _breaker.record(True, probe)
+            tracing.set_attrs(**{"upstream.attempts": attempt})
+            return r
+        finally:
+            _breaker.release(probe)
+
+        _count("retry")
+        time.sleep(delay)
+
+
+# ----------------------------
+# Response cache, invalidated by the API's /catalog/changes feed
+# ----------------------------
+CacheKey = Tuple[str, Tuple[Tuple[str, Any], ...]]
+
+
+class _ResponseCache:
+    """
+    Caches GET responses. Each entry remembers which hotel ids it contains so a
+    change event only evicts what it can affect: a delete drops entries holding
+    that id, an upsert also drops every query result (the hotel may now match).
+    Bounded to CACHE_MAX_ENTRIES, least recently used first.
+
+    While the feed is disconnected, entries stored before the disconnect are
+    "unverified": they may have missed events, so they only serve stale reads
+    until the reconnect has replayed everything since our version.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[CacheKey, Tuple[float, bool, frozenset, Any]]" = OrderedDict()
+        self.version = 0
+        self.epoch = ""
+        self._unverified_before: Optional[float] = None
+        self._verified_at_version: Optional[int] = None
+
+    def get(self, key: CacheKey, allow_stale: bool = False) -> Optional[Any]:
+        # Stale means past TTL or unverified; entries the feed evicted are gone
+        with self._lock:
+            hit = self._entries.get(key)
+            if not hit:
+                return None
+            age = time.monotonic() - hit[0]
+            if allow_stale:
+                if age > CACHE_TTL_S + CACHE_STALE_S:
+                    return None
+            elif age > CACHE_TTL_S or (
+                self._unverified_before is not None and hit[0] < self._unverified_before
+            ):
+                return None
+            self._entries.move_to_end(key)
+            return hit[3]
+
+    def put(
+        self, key: CacheKey, is_query: bool, ids: frozenset, value: Any, version: int, epoch: str
+    ) -> None:
+        with self._lock:
+            # A response older than an event we've applied may already be stale,
+            # and one from another API process can't be ordered against ours
+            if version < self.version or (self.epoch and epoch != self.epoch):
+                return
+            now = time.monotonic()
+            for k in [k for k, e in self._entries.items() if now - e[0] > CACHE_TTL_S + CACHE_STALE_S]:
+                del self._entries[k]
+            self._entries[key] = (now, is_query, ids, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > CACHE_MAX_ENTRIES:
+                self._entries.popitem(last=False)
+
+    def apply(self, event: Dict[str, Any]) -> None:
+        hotel_id, upsert = event["id"], event["op"] == "upsert"
+        with self._lock:
+            self.version = max(self.version, event["version"])
+            for key, (_, is_query, ids, _) in list(self._entries.items()):
+                if hotel_id in ids or (upsert and is_query):
+                    del self._entries[key]
+            if self._verified_at_version is not None and self.version >= self._verified_at_version:
+                self._unverified_before = self._verified_at_version = None
+
+    def disconnected(self) -> None:
+        with self._lock:
+            if self._unverified_before is None:
+                self._unverified_before = time.monotonic()
+            self._verified_at_version = None
+
+    def resumed(self, version: int) -> None:
+        # The feed replays events up to `version` right after hello
+        with self._lock:
+            if self.version >= version:
+                self._unverified_before = self._verified_at_version = None
+            else:
+                self._verified_at_version = version
+
+    def reset(self, version: int, epoch: Optional[str] = None) -> None:
+        with self._lock:
+            self.version = version
+            if epoch is not None:
+                self.epoch = epoch
+            self._entries.clear()
+            self._unverified_before = self._verified_at_version = None
+
+
+_cache = _ResponseCache()
+_feed_started = False
+_feed_lock = threading.Lock()
+
+
+def _follow_changes() -> None:
+    backoff = 1.0
+    while True:
+        try:
+            params: Dict[str, Any] = {}
+            if _cache.version:
+                params = {"since": _cache.version, "epoch": _cache.epoch}
+            timeout = httpx.Timeout(TIMEOUT_S, read=2 * CHANGE_KEEPALIVE_S)
+            with httpx.Client(base_url=API_BASE_URL, timeout=timeout) as c:
+                with c.stream("GET", "/catalog/changes", params=params) as r:
+                    r.raise_for_status()
+                    backoff = 1.0
+                    event = ""
+                    for line in r.iter_lines():
+                        if line.startswith("event:"):
+                            event = line[6:].strip()
+                        elif line.startswith("data:"):
+                            data = json.loads(line[5:])
+                            if event == "change":
+                                _cache.apply(data)
+                            elif event == "reset" or (
+                                # First connect, or the API restarted and its versions went back
+                                event == "hello"
+                                and (
+                                    not _cache.version
+                                    or data["version"] < _cache.version
+                                    or data.get("epoch") != _cache.epoch
+                                )
+                            ):
+                                _cache.reset(data["version"], data.get("epoch"))
+                            elif event == "hello":
+                                _cache.resumed(data["version"])
+        except (httpx.HTTPError, ValueError):
+            pass
+        except Exception:
+            # A malformed event or anything else must not kill the follower thread
+            log.exception("Catalog change feed failed; reconnecting")
+        # Events may be missed until we reconnect; keep entries for stale reads
+        _cache.disconnected()
+        time.sleep(backoff)
+        backoff = min(backoff * 2, 30.0)
+
+
+def _ensure_change_feed() -> None:
+    global _feed_started
+    if not CHANGE_FEED or _feed_started:
+        return
+    with _feed_lock:
+        if not _feed_started:
+            threading.Thread(target=_follow_changes, name="clubmed-changes", daemon=True).start()
+            _feed_started = True
+
+
+def _cached_get(
+    tool: str,
+    path: str,
+    params: Optional[Dict[str, Any]] = None,
+    route: Optional[str] = None,
+) -> Dict[str, Any]:
+    _ensure_change_feed()
+    items = ((k, tuple(v) if isinstance(v, list) else v) for k, v in (params or {}).items())
+    key: CacheKey = (path, tuple(sorted(items)))
+    hit = _cache.get(key)
+    tracing.set_attrs(**{"cache.hit": hit is not None})
+    if hit is not None:
+        return hit
+
+    try:
+        r = _call(tool, "GET", path, params=params, route=route or path)
+    except (httpx.HTTPError, UpstreamUnavailable) as e:
+        stale = _cache.get(key, allow_stale=True)
+        if stale is None or (isinstance(e, httpx.HTTPError) and not _retryable(e)):
+            raise
+        _count("stale.served")
+        tracing.set_attrs(**{"cache.stale": True})
+        return stale
+    data = r.json()
+
+    version = int(r.headers.get("X-Catalog-Version", "0"))
+    epoch = r.headers.get("X-Catalog-Epoch", "")
+    if "hotels" in data:
+        _cache.put(key, True, frozenset(h["id"] for h in data["hotels"]), data, version, epoch)
+    elif "hotel" in data:
+        _cache.put(key, False, frozenset([data["hotel"]["id"]]), data, version, epoch)
+    return data
+
+
 def _clean_params(
     query: str = "",
     country: Optional[str] = None,
@@ -48,19 +542,15 @@ def list_hotels(
 ) -> Dict[str, Any]:
     """Get hotels/villages in React-friendly shape."""
     params = _clean_params(query, country, region, themes, limit)
-    with _client() as c:
-        r = c.get("/hotels", params=params)
-        r.raise_for_status()
-        return r.json()
+    with tracing.span("tool.list_hotels"):
+        return _cached_get("list_hotels", "/hotels", params)
 
 
 @mcp.tool()
 def get_hotel(hotel_id: str) -> Dict[str, Any]:
     """Fetch a single hotel/village by id."""
-    with _client() as c:
-        r = c.get(f"/hotels/{hotel_id}")
-        r.raise_for_status()
-        return r.json()
+    with tracing.span("tool.get_hotel", **{"hotel.id": hotel_id}):
+        return _cached_get("get_hotel", f"/hotels/{hotel_id}", route="/hotels/{hotel_id}")
 
 
 @mcp.tool()
@@ -76,10 +566,8 @@ def map_search(
     bounds shape matches React: {minX,maxX,minY,maxY} where X=lng and Y=lat.
     """
     params = _clean_params(query, country, region, themes, limit)
-    with _client() as c:
-        r = c.get("/map/search", params=params)
-        r.raise_for_status()
-        return r.json()
+    with tracing.span("tool.map_search"):
+        return _cached_get("map_search", "/map/search", params)
 
 
 @mcp.tool()
@@ -98,45 +586,55 @@ def get_quote(
         "adults": adults,
         "children": children,
     }
-    with _client() as c:
-        r = c.post("/quote", json=payload)
-        r.raise_for_status()
-        return r.json()
+    with tracing.span("tool.get_quote", **{"hotel.id": hotel_id}):
+        # /quote only computes a price, so it is safe to retry or hedge
+        return _call("get_quote", "POST", "/quote", json=payload).json()
 
 
 # Optional: connector-style search/fetch (nice for generic browsing flows)
 @mcp.tool()
 def search(query: str) -> Dict[str, Any]:
-    with _client() as c:
-        r = c.get("/hotels", params={"q": query, "limit": 10})
-        r.raise_for_status()
-        data = r.json()
-
-    results = []
-    for h in data.get("hotels", []):
-        results.append(
-            {
-                "id": h["id"],
-                "title": f'{h["name"]} ({h["country"]})',
-                "snippet": f'Region: {h["region"]}. Themes: {", ".join(h.get("themes", []))}. Rating: {h.get("rating")}',
-                "url": h.get("bookingUrl"),
-                "metadata": {"type": "hotel"},
-            }
-        )
-    return {"results": results}
+    with tracing.span("tool.search"):
+        data = _cached_get("search", "/hotels", {"q": query, "limit": 10})
+
+        results = []
+        for h in data.get("hotels", []):
+            results.append(
+                {
+                    "id": h["id"],
+                    "title": f'{h["name"]} ({h["country"]})',
+                    "snippet": f'Region: {h["region"]}. Themes: {", ".join(h.get("themes", []))}. Rating: {h.get("rating")}',
+                    "url": h.get("bookingUrl"),
+                    "metadata": {"type": "hotel"},
+                }
+            )
+        return {"results": results}
 
 
 @mcp.tool()
 def fetch(id: str) -> Dict[str, Any]:
-    with _client() as c:
-        r = c.get(f"/hotels/{id}")
-        if r.status_code == 404:
+    with tracing.span("tool.fetch", **{"hotel.id": id}):
+        try:
+            payload = {"ok": True, **_cached_get("fetch", f"/hotels/{id}", route="/hotels/{hotel_id}")}
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 404:
+                raise
             payload = {"ok": False, "reason": f"Unknown id: {id}"}
-        else:
-            r.raise_for_status()
-            payload = {"ok": True, **r.json()}
 
-    return {"content": [{"type": "text", "text": json.dumps(payload, ensure_ascii=False)}]}
+        return {"content": [{"type": "text", "text": json.dumps(payload, ensure_ascii=False)}]}
+
+
+# Operator-facing, deliberately not an MCP tool: the model has no use for it
+def upstream_stats() -> Dict[str, Any]:
+    """Counters for retries, hedges, breaker and stale-cache decisions."""
+    with _stats_lock:
+        counters = dict(_stats)
+    return {
+        "counters": counters,
+        "breaker": _breaker.state,
+        "p95_s": {tool: _latency.p95(tool) for tool in TOOL_BUDGETS_S},
+        "budgets_s": {tool: _budget(tool) for tool in TOOL_BUDGETS_S},
+    }
 
 
 if __name__ == "__main__":
@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import os
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Mapping, Optional
+
+# OpenTelemetry is optional: without the SDK (or with CLUBMED_TRACE_EXPORT unset)
+# every helper here is a cheap no-op.
+try:
+    from opentelemetry import propagate, trace
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+    from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+except ImportError:  # pragma: no cover - depends on environment
+    trace = None
+
+# "" (off), "file" (JSON lines) or "otlp" (OTLP/HTTP collector)
+TRACE_EXPORT = os.getenv("CLUBMED_TRACE_EXPORT", "")
+TRACE_FILE = os.getenv("CLUBMED_TRACE_FILE", "clubmed-traces.jsonl")
+TRACE_ENDPOINT = os.getenv("CLUBMED_TRACE_ENDPOINT", "http://127.0.0.1:4318/v1/traces")
+# Fraction of new traces to keep; child spans follow the caller's decision
+TRACE_SAMPLE = float(os.getenv("CLUBMED_TRACE_SAMPLE", "1.0"))
+
+_tracer = None
+
+
+def setup(service_name: str) -> None:
+    """Install the tracer provider for this process (call once at import)."""
+    global _tracer
+    if trace is None or not TRACE_EXPORT or _tracer is not None:
+        return
+
+    if TRACE_EXPORT == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+        exporter = OTLPSpanExporter(endpoint=TRACE_ENDPOINT)
+    elif TRACE_EXPORT == "file":
+        exporter = ConsoleSpanExporter(
+            out=open(TRACE_FILE, "a", encoding="utf-8"),
+            formatter=lambda s: s.to_json(indent=None) + "\n",
+        )
+    else:
+        raise ValueError(f"Unknown CLUBMED_TRACE_EXPORT: {TRACE_EXPORT!r}")
+
+    provider = TracerProvider(
+        resource=Resource.create({"service.name": service_name}),
+        sampler=ParentBased(TraceIdRatioBased(TRACE_SAMPLE)),
+    )
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    _tracer = provider.get_tracer("clubmed")
+
+
+def enabled() -> bool:
+    return _tracer is not None
+
+
+@contextmanager
+def span(name: str, parent: Optional[Any] = None, **attrs: Any) -> Iterator[Optional[Any]]:
+    """Start a child of the current span (or of `parent`, an extracted context)."""
+    if _tracer is None:
+        yield None
+        return
+    with _tracer.start_as_current_span(name, context=parent) as s:
+        for k, v in attrs.items():
+            if v is not None:
+                s.set_attribute(k, v if isinstance(v, (str, bool, int, float)) else str(v))
+        yield s
+
+
+def set_attrs(**attrs: Any) -> None:
+    if _tracer is None:
+        return
+    s = trace.get_current_span()
+    for k, v in attrs.items():
+        if v is not None:
+            s.set_attribute(k, v)
+
+
+def inject(headers: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """Add W3C traceparent headers for the current span."""
+    headers = dict(headers or {})
+    if _tracer is not None:
+        propagate.inject(headers)
+    return headers
+
+
+def extract(headers: Mapping[str, str]) -> Optional[Any]:
+    if _tracer is None:
+        return None
+    return propagate.extract(headers)
+
+
+def httpx_trace_hook(event_name: str, info: Dict[str, Any]) -> None:
+    """
+    httpx `extensions={"trace": ...}` callback: records connect/TLS/send/receive
+    as events on the current span, so handshake time shows up per request.
+    """
+    if _tracer is None:
+        return
+    trace.get_current_span().add_event(event_name)